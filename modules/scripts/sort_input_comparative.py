@@ -5,6 +5,13 @@ import logging
 import matplotlib.pyplot as plt
 import seaborn as sns
 import argparse
+import numpy as np
+from multiprocessing import Pool, freeze_support
+
+# Minimum number of grid points the scores are binned onto before the KDE convolution
+KDE_GRID_SIZE = 1024
+# Upper bound on the KDE grid when a narrow bandwidth needs a finer grid
+KDE_MAX_GRID_SIZE = 2 ** 20
 
 def custom_chr_sort(chrom):
     """Custom sort function for chromosomes, handling both numeric and 'chrX', 'chrY'."""
@@ -12,6 +19,75 @@ def custom_chr_sort(chrom):
         chrom = chrom[3:]
     return chrom.zfill(2) if chrom.isdigit() else chrom
 
+def binned_kde(values, grid_size=KDE_GRID_SIZE):
+    """Gaussian KDE (Scott's bandwidth) evaluated on a regular grid spanning the data, via FFT convolution of linearly binned counts."""
+    n = values.size
+    if n < 2:
+        return None, None
+    std = values.std(ddof=1)
+    if std == 0:
+        return None, None
+    bandwidth = std * n ** (-1 / 5)
+
+    # Keep at least three grid points per bandwidth so the kernel stays resolved when an outlier stretches the range
+    lo, hi = values.min(), values.max()
+    grid_size = int(min(max(grid_size, np.ceil(3 * (hi - lo) / bandwidth) + 1), KDE_MAX_GRID_SIZE))
+    grid = np.linspace(lo, hi, grid_size)
+    delta = grid[1] - grid[0]
+
+    # Linear binning: split each score between its two neighbouring grid points
+    position = (values - lo) / delta
+    index = np.minimum(position.astype(np.int64), grid_size - 2)
+    fraction = position - index
+    grid_counts = (np.bincount(index, weights=1 - fraction, minlength=grid_size)
+                   + np.bincount(index + 1, weights=fraction, minlength=grid_size))
+
+    # Gaussian kernel sampled on the grid spacing, truncated at 4 bandwidths or at the grid span
+    full_width = int(np.ceil(4 * bandwidth / delta))
+    half_width = min(full_width, grid_size - 1)
+    offsets = np.arange(-half_width, half_width + 1) * delta
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    if half_width == full_width:
+        # Normalize the sampled kernel to unit area so coarse grids do not inflate the density
+        kernel /= kernel.sum() * delta
+    else:
+        # The grid span cut the kernel short (small samples), keep the analytic Gaussian constant
+        kernel /= bandwidth * np.sqrt(2 * np.pi)
+
+    # Zero-padded FFT convolution, keeping the part aligned with the grid
+    nfft = 1 << (grid_size + kernel.size - 2).bit_length()
+    convolved = np.fft.irfft(np.fft.rfft(grid_counts, nfft) * np.fft.rfft(kernel, nfft), nfft)
+    density = np.clip(convolved[half_width:half_width + grid_size], 0, None) / n
+    return grid, density
+
+def compute_score_distribution(scores, bins):
+    """Histogram counts and a count-scaled density curve for the given scores."""
+    counts, edges = np.histogram(scores, bins=bins)
+    distribution = {'counts': counts, 'edges': edges}
+    kde_x, kde_density = binned_kde(scores)
+    if kde_x is not None:
+        # Scale the density to the histogram counts, as seaborn does for stat='count'
+        distribution['kde_x'] = kde_x
+        distribution['kde_y'] = kde_density * scores.size * (edges[1] - edges[0])
+    return distribution
+
+def plot_binned_distribution(distribution, title, plot_path):
+    """Plot a pre-binned histogram with its density curve on a log scale and save it to plot_path."""
+    edges = distribution['edges']
+    color = sns.color_palette()[0]
+    plt.figure(figsize=(10, 6))
+    # Weighted bin centers keep the histogram cost independent of the number of peaks
+    sns.histplot(x=(edges[:-1] + edges[1:]) / 2, weights=distribution['counts'], bins=edges, color=color, edgecolor='black')
+    if 'kde_x' in distribution:
+        plt.plot(distribution['kde_x'], distribution['kde_y'], color=color)
+    plt.xlabel('Score')
+    plt.ylabel('Frequency')
+    plt.title(title)
+    plt.yscale('log')  # Use a logarithmic scale for the y-axis
+    plt.grid(True, axis='y')  # Add horizontal grid lines
+    plt.savefig(plot_path)
+    plt.close()
+
 def select_and_sort_peaks(input_bedfile, output_bedfile, plot_folder, c_top_n):
     # Read the BED file into a pandas DataFrame
     df = pd.read_csv(input_bedfile, sep='\t', header=None)
@@ -43,40 +119,36 @@ def select_and_sort_peaks(input_bedfile, output_bedfile, plot_folder, c_top_n):
 
     # Filter scores between 1 and 10000
     valid_scores = df_final_sorted[4][(df_final_sorted[4] >= 1) & (df_final_sorted[4] <= 10000)]
-
-    # Plot histogram with adjusted bin edges
-    plt.figure(figsize=(10, 6))
-    sns.histplot(valid_scores, bins=50, kde=True, edgecolor='black')
-    plt.xlabel('Score')
-    plt.ylabel('Frequency')
-    plt.title(f'Score Distribution for {os.path.basename(input_bedfile)}')
-    plt.yscale('log')  # Use a logarithmic scale for the y-axis
-    plt.grid(True, axis='y')  # Add horizontal grid lines
-
-    # Save the plot as a PNG file in the plot folder
-    plot_filename = f"{os.path.splitext(os.path.basename(input_bedfile))[0]}_score_distribution.png"
-    plot_path = os.path.join(plot_folder, plot_filename)
-    plt.savefig(plot_path)
-    plt.close()
-
-    # Plot a separate histogram for high score values
-    high_scores = valid_scores[valid_scores > valid_scores.quantile(0.95)]
-    if not high_scores.empty:
-        plt.figure(figsize=(10, 6))
-        sns.histplot(high_scores, bins=20, kde=True, edgecolor='black')
-        plt.xlabel('Score')
-        plt.ylabel('Frequency')
-        plt.title(f'Distribution of High Scores for {os.path.basename(input_bedfile)}')
-        plt.yscale('log')  # Use a logarithmic scale for the y-axis
-        plt.grid(True, axis='y')  # Add horizontal grid lines
-
-        # Save the high score plot as a PNG file in the plot folder
-        high_score_plot_filename = f"{os.path.splitext(os.path.basename(input_bedfile))[0]}_high_score_distribution.png"
-        high_score_plot_path = os.path.join(plot_folder, high_score_plot_filename)
-        plt.savefig(high_score_plot_path)
-        plt.close()
-
-def process_all_bed_files_in_folder(input_folder, output_folder, plot_folder, top_n):
+    valid_scores = valid_scores.to_numpy(dtype=float)
+
+    # Bin the scores for the full and the high score (top 5%) distributions
+    distributions = {'score': compute_score_distribution(valid_scores, bins=50)}
+    if valid_scores.size:
+        high_scores = valid_scores[valid_scores > np.quantile(valid_scores, 0.95)]
+        if high_scores.size:
+            distributions['high_score'] = compute_score_distribution(high_scores, bins=20)
+
+    # Save the binned metrics next to the plots so figures can be rendered without rereading the BED file
+    sample_name = os.path.splitext(os.path.basename(input_bedfile))[0]
+    metrics_path = os.path.join(plot_folder, f"{sample_name}_score_distribution.npz")
+    np.savez(metrics_path, **{f"{kind}_{key}": value for kind, dist in distributions.items() for key, value in dist.items()})
+    logging.info(f'Score distribution metrics for {input_bedfile} saved to {metrics_path}')
+
+    return sample_name, distributions
+
+def render_score_distributions(task):
+    """Render the score distribution plots of one sample from its pre-binned counts."""
+    sample_name, distributions, plot_folder = task
+    try:
+        plot_binned_distribution(distributions['score'], f'Score Distribution for {sample_name}.bed',
+                                 os.path.join(plot_folder, f"{sample_name}_score_distribution.png"))
+        if 'high_score' in distributions:
+            plot_binned_distribution(distributions['high_score'], f'Distribution of High Scores for {sample_name}.bed',
+                                     os.path.join(plot_folder, f"{sample_name}_high_score_distribution.png"))
+    except Exception as e:
+        logging.error(f"Error plotting {sample_name}: {str(e)}")
+
+def process_all_bed_files_in_folder(input_folder, output_folder, plot_folder, top_n, workers=1, metrics_only=False):
     # Ensure the output folder and plot folder exist
     os.makedirs(output_folder, exist_ok=True)
     os.makedirs(plot_folder, exist_ok=True)
@@ -85,25 +157,44 @@ def process_all_bed_files_in_folder(input_folder, output_folder, plot_folder, to
     bedfiles = glob.glob(os.path.join(input_folder, '*.bed'))
 
     # Process and sort each bed file
+    render_tasks = []
     for bedfile in bedfiles:
         try:
             # Construct the output file path
             output_bedfile = os.path.join(output_folder, os.path.basename(bedfile))
 
             # Select the top N peaks based on score, then sort by chromosome and feature size
-            select_and_sort_peaks(bedfile, output_bedfile, plot_folder, top_n)
+            sample_name, distributions = select_and_sort_peaks(bedfile, output_bedfile, plot_folder, top_n)
+            render_tasks.append((sample_name, distributions, plot_folder))
         except Exception as e:
             logging.error(f"Error processing {bedfile}: {str(e)}")
 
+    if metrics_only:
+        logging.info('Metrics only mode, skipping score distribution plots.')
+        return
+
+    # Render the plots from the binned metrics once all files are processed
+    if workers > 1:
+        with Pool(processes=workers) as pool:
+            pool.map(render_score_distributions, render_tasks)
+    else:
+        for task in render_tasks:
+            render_score_distributions(task)
+
 if __name__ == '__main__':
+    freeze_support()  # for Windows compatibility
+
     parser = argparse.ArgumentParser(description='Process and plot BED files for comparison.')
     parser.add_argument('input_folder', type=str, help='Input folder containing BED files for comparison.')
     parser.add_argument('output_folder', type=str, help='Output folder for processed BED files.')
     parser.add_argument('plot_folder', type=str, help='Output folder for score distribution plots.')
     parser.add_argument('top_n', type=int, help='Number of top peaks to select.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to render the plots.')
+    parser.add_argument('--metrics-only', action='store_true', help='Only save the binned score metrics, skip rendering the plots.')
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    process_all_bed_files_in_folder(args.input_folder, args.output_folder, args.plot_folder, args.top_n)
+    process_all_bed_files_in_folder(args.input_folder, args.output_folder, args.plot_folder, args.top_n,
+                                    workers=args.workers, metrics_only=args.metrics_only)